@@ -1,77 +1,198 @@
 import argparse
 import base64
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import hashlib
 import io
+import itertools
 import json
 import logging
 from logging.config import dictConfig
+import operator
 import os.path
 import re
 import sys
+import threading
 import time
 from typing import Optional
+from urllib.parse import urlencode
 
 import requests
 from tqdm import tqdm
 
-template_re = re.compile(r"\[(.*?)\]|(\w[\w-]*)(?:\s+(as\s+%))?")
+try:
+    # orjson is optional, but much faster than the standard library at parsing large responses
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 ann_type_re = re.compile(r"^(\S+)(?:\s+(.*))?$")
-lt_amp_re = re.compile(r"&(amp|lt);")
 
 logger = logging.getLogger(__name__)
 
 accept_json = {"Accept": "application/json"}
 
+get_indices = operator.itemgetter("indices")
 
-def lt_amp_replacement(m):
-    if m.group(1) == "amp":
-        return "&"
-    else:
-        return "<"
+# Service metadata rarely changes, so it is cached on disk for a day
+metadata_cache_dir = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "gate-cloud-tools", "metadata"
+)
+metadata_cache_max_age = 24 * 60 * 60
 
 
 def unescape_lt_amp(s: str):
-    return lt_amp_re.sub(lt_amp_replacement, s)
+    # most annotation text has no entities at all, and "in" is a very cheap check.  &lt; must be
+    # replaced before &amp; so that "&amp;lt;" correctly becomes "&lt;" rather than "<"
+    return s if "&" not in s else s.replace("&lt;", "<").replace("&amp;", "&")
 
 
-def text_under(ann_type: str, separator: str):
-    def resp_func(response):
-        return separator.join(
-            unescape_lt_amp(response["text"][slice(*(it["indices"]))]) for it in response["entities"].get(ann_type, [])
-        )
+def error_message(err_json: dict) -> str:
+    if "message" in err_json:
+        return f"Error: {err_json['message']}"
+    else:
+        return f"Error: {json.dumps(err_json)}"
 
-    return resp_func
 
+def columns_getter(columns: list[int]):
+    """
+    Construct a function that copies the given columns out of a CSV row into a new list, using
+    itemgetter so the indexing happens in C rather than in a list comprehension.
+    """
+    if not columns:
+        return lambda row: []
+    getter = operator.itemgetter(*columns)
+    if len(columns) == 1:
+        # itemgetter with a single index returns the item itself rather than a tuple
+        return lambda row: [getter(row)]
+    return lambda row: list(getter(row))
 
-def response_to_column(ann_type: str, template: str, separator: str):
-    def resp_func(response):
-        chunks = []
-        for ann in response["entities"].get(ann_type, []):
 
-            def replacement(m):
-                literal, feature, modifier = m.groups()
-                if literal:
-                    return literal
-                elif feature == "text":
-                    return unescape_lt_amp(response["text"][slice(*(ann["indices"]))])
-                elif feature in ann:
-                    if modifier == "as %":
-                        return "{:.2%}".format(ann[feature])
-                    else:
-                        return str(ann[feature])
-                else:
-                    return f"{feature} not found"
+# Each of the output column builders below returns the source of a Python expression that computes
+# the column value from the response "text" and "entities".  compile_output_expressions combines these
+# into a single function that extracts all the output columns in one go.
+
 
-            chunks.append(template_re.sub(replacement, template))
+def annotation_present(ann_type: str) -> str:
+    return f'"1" if entities.get({ann_type!r}) else "0"'
 
-        return separator.join(chunks)
 
-    return resp_func
+def annotation_count(ann_type: str) -> str:
+    return f"str(len(entities.get({ann_type!r}, ())))"
 
 
-def output_function(col: str, type_to_sel: dict):
+def build_text_under(text: str, anns: list, separator: str) -> str:
     """
-    Construct the function that will generate the output for a given column definition.
+    Join the text covered by each of the given annotations.  This is the innermost loop for long
+    documents with many annotations, so it takes the response text directly rather than looking it
+    up again for every annotation.
+    """
+    return separator.join([unescape_lt_amp(text[start:end]) for start, end in map(get_indices, anns)])
+
+
+def text_under(ann_type: str, separator: str) -> str:
+    return f"build_text_under(text, entities.get({ann_type!r}, ()), {separator!r})"
+
+
+def is_word_char(c: str) -> bool:
+    # the same characters as \w in a regular expression
+    return c.isalnum() or c == "_"
+
+
+def skip_spaces(template: str, pos: int) -> int:
+    while pos < len(template) and template[pos].isspace():
+        pos += 1
+    return pos
+
+
+def parse_template(template: str) -> list[tuple]:
+    """
+    Parse a feature template into a list of instructions, once per column rather than once per
+    annotation.  The template is made up of feature names (words, optionally followed by "as %"),
+    literal text in [square brackets], and any other text, which is copied through as-is.
+
+    Returns:
+        list of instructions, each of which is one of ("lit", text), ("text",) for the text under
+        the annotation, ("feat", name) for the value of a feature, or ("pct", name) for the value of
+        a feature formatted as a percentage
+    """
+    instructions = []
+    literal = []
+    pos = 0
+    while pos < len(template):
+        c = template[pos]
+        if c == "[" and "]" in template[pos + 1 :]:
+            end = template.index("]", pos + 1)
+            # an empty [] produces no output at all (the old regex-based version rendered it
+            # as "None not found")
+            literal.append(template[pos + 1 : end])
+            pos = end + 1
+        elif is_word_char(c):
+            end = pos + 1
+            while end < len(template) and (is_word_char(template[end]) or template[end] == "-"):
+                end += 1
+            feature = template[pos:end]
+            pos = end
+
+            # check for " as %"
+            modifier = None
+            as_start = skip_spaces(template, pos)
+            if as_start > pos and template.startswith("as", as_start):
+                pct_start = skip_spaces(template, as_start + 2)
+                if pct_start > as_start + 2 and template.startswith("%", pct_start):
+                    modifier = template[as_start : pct_start + 1]
+                    pos = pct_start + 1
+
+            if literal:
+                instructions.append(("lit", "".join(literal)))
+                literal = []
+            if feature == "text":
+                instructions.append(("text",))
+            elif modifier == "as %":
+                instructions.append(("pct", feature))
+            else:
+                # any other spacing of "as %" is swallowed but has no effect
+                instructions.append(("feat", feature))
+        else:
+            literal.append(c)
+            pos += 1
+
+    if literal:
+        instructions.append(("lit", "".join(literal)))
+    return instructions
+
+
+def render_template(instructions: list[tuple], ann: dict, text: str) -> str:
+    chunks = []
+    for instruction in instructions:
+        op = instruction[0]
+        if op == "lit":
+            chunks.append(instruction[1])
+        elif op == "text":
+            start, end = ann["indices"]
+            chunks.append(unescape_lt_amp(text[start:end]))
+        elif instruction[1] not in ann:
+            chunks.append(f"{instruction[1]} not found")
+        elif op == "pct":
+            chunks.append("{:.2%}".format(ann[instruction[1]]))
+        else:
+            chunks.append(str(ann[instruction[1]]))
+    return "".join(chunks)
+
+
+def response_to_column(ann_type: str, template: str, separator: str) -> str:
+    # a tuple of tuples of strings is compiled as a single constant
+    instructions = tuple(parse_template(template))
+    return (
+        f"{separator!r}.join([render_template({instructions!r}, ann, text)"
+        f" for ann in entities.get({ann_type!r}, ())])"
+    )
+
+
+def output_expression(col: str, type_to_sel: dict):
+    """
+    Construct the expression that will generate the output for a given column definition.
 
     Arguments:
         col: column definition, typically either "AnnotationType" representing the text under that
@@ -81,8 +202,8 @@ def output_function(col: str, type_to_sel: dict):
 
     Returns:
         tuple of the annotation selector that must be passed to the service in order to retrieve the
-        type of annotation that the function will operate on, and the actual function that takes a GATE Cloud
-        API response and extracts the appropriate value(s) from it
+        type of annotation that the expression will operate on, and the source of the Python expression that
+        extracts the appropriate value(s) from a GATE Cloud API response (see compile_output_expressions)
     """
     logger.info("Processing column definition: %s", col)
     ann_type, rest = ann_type_re.match(col.strip()).groups()
@@ -96,25 +217,54 @@ def output_function(col: str, type_to_sel: dict):
 
     if not rest or rest == "text":
         logger.info("Using text under annotation type %s", ann_type)
-        fn = text_under(ann_type, ";")
+        expression = text_under(ann_type, ";")
     elif rest == "present?":
         logger.info("Existence check - 1 if annotation type %s is present, 0 otherwise", ann_type)
-        fn = lambda resp: str(1 if len(resp["entities"].get(ann_type, [])) > 0 else 0)
+        expression = annotation_present(ann_type)
     elif rest == "#count":
         logger.info("Annotation count - number of occurrences of annotation type %s", ann_type)
-        fn = lambda resp: str(len(resp["entities"].get(ann_type, [])))
+        expression = annotation_count(ann_type)
     else:
         # The full version
         logger.info("Annotation feature template")
-        fn = response_to_column(ann_type, rest, ";")
+        expression = response_to_column(ann_type, rest, ";")
 
-    return ann_selector, fn
+    return ann_selector, expression
+
+
+def compile_output_expressions(expressions: list[str]):
+    """
+    Generate a single function that takes a GATE Cloud API response and returns the list of values of all
+    the given column expressions, so each response needs one Python function call rather than one per column.
+    """
+    source = (
+        "def extract_outputs(response):\n"
+        "    text = response['text']\n"
+        "    entities = response['entities']\n"
+        f"    return [{', '.join(expressions)}]\n"
+    )
+    logger.debug("Generated output column function:\n%s", source)
+    namespace = {}
+    exec(compile(source, "<output columns>", "exec"), globals(), namespace)
+    return namespace["extract_outputs"]
 
 
 class CsvProcessor:
     def __init__(self, args, credentials):
+        # Rate limiting state, shared between all the worker threads and
+        # protected by rate_limit_lock
+        self.rate_limit_lock = threading.Lock()
         self.prev_rate_limit_remaining = -1
-        self.request_start_time: Optional[float] = None
+        self.next_call_time = 0.0
+        self.call_interval = 0.0
+        # Number of times in a row that calls have hit the rate limit, and when the last of those
+        # was seen.  Calls that had already started by then don't count again, so one burst of
+        # parallel calls hitting the limit together only counts once.
+        self.rate_limit_failures = 0
+        self.last_rate_limit_time = 0.0
+        # Set when any worker gives up on the rate limit, so that all the others stop straight
+        # away rather than each running out its own retries
+        self.give_up = threading.Event()
 
         self.separator = args.separator
         self.has_headers = args.has_headers
@@ -127,7 +277,21 @@ class CsvProcessor:
         self.endpoint = args.endpoint
         logger.info("Using GATE Cloud endpoint: %s", self.endpoint)
 
-        self.session = requests.Session()
+        self.concurrency = args.concurrency
+        logger.info("Making up to %d API calls in parallel", self.concurrency)
+        self.dedup_cache_size = args.dedup_cache
+        if self.dedup_cache_size:
+            logger.info("Re-using results for up to %d recently seen texts", self.dedup_cache_size)
+
+        # requests.Session is not guaranteed to be thread safe, so each worker thread gets its
+        # own copy of self.session (see get_session).  They all share one HTTPAdapter, whose
+        # urllib3 connection pool is thread safe, so connections are kept alive and re-used
+        # between calls.  The pool must be big enough to hold one connection per worker,
+        # otherwise connections are closed and re-opened (with a fresh TLS handshake) as soon
+        # as more than 10 calls overlap.
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.thread_local = threading.local()
+        self.session = self.new_session()
         self.session.headers["Accept"] = "application/json"
         if credentials:
             auth_header = "Basic " + base64.b64encode(bytes(credentials, "utf-8")).decode("ascii")
@@ -135,6 +299,7 @@ class CsvProcessor:
 
         # Parse the service metadata to get the appropriate annotation set name
         # for each annotation type
+        self.use_metadata_cache = args.metadata_cache
         self.type_to_sel = self.get_annotations_from_metadata()
 
         self.session.headers["Content-Type"] = args.mime_type
@@ -147,79 +312,221 @@ class CsvProcessor:
         output_columns = [c.strip() for c in args.results]
         self.output_columns = [c for c in output_columns if c]
         logger.info("Annotation output columns: %s", self.output_columns)
-        selectors_and_functions = zip(*(output_function(c, self.type_to_sel) for c in self.output_columns))
-
-        # output_function returns a (str, func) tuple so zip unpacks this into an iterable
-        # of strings (selectors) and an iterable of functions.  De-duplicate selectors
-        # and use them as the ?annotations=... query param, and save the functions in a
-        # list for later use to unpack the responses
-        self.ann_selectors = dict(annotations=frozenset(next(selectors_and_functions)))
-        self.output_functions = list(next(selectors_and_functions))
+
+        # output_expression returns a (selector, expression) tuple for each column.  De-duplicate
+        # the selectors and use them as the ?annotations=... query param, and compile the
+        # expressions into one function for later use to unpack the responses
+        selectors = set()
+        expressions = []
+        for c in self.output_columns:
+            selector, expression = output_expression(c, self.type_to_sel)
+            selectors.add(selector)
+            expressions.append(expression)
+        self.extract_outputs = compile_output_expressions(expressions)
+        # sorted, so the query string is the same from one run to the next
+        self.ann_selectors = dict(annotations=sorted(selectors))
         logger.info("Annotation selectors to send to service: %s", self.ann_selectors)
 
-    def get_annotations_from_metadata(self):
+        # The query string is the same for every call, so build the URL once rather than
+        # having requests encode the parameters again for every row
+        query = urlencode(self.ann_selectors, doseq=True)
+        self.post_url = self.endpoint + ("&" if "?" in self.endpoint else "?") + query
+
+    def fetch_service_metadata(self) -> Optional[dict]:
+        """
+        Get the metadata for the service, from the local cache if we have a recent enough copy.
+
+        Returns:
+            the parsed metadata, or None if it could not be retrieved
+        """
+        cache_file = os.path.join(metadata_cache_dir, hashlib.sha1(self.endpoint.encode("utf-8")).hexdigest() + ".json")
+        if self.use_metadata_cache:
+            try:
+                if time.time() - os.path.getmtime(cache_file) < metadata_cache_max_age:
+                    with open(cache_file, encoding="utf-8") as f:
+                        service_metadata = json.load(f)
+                    logger.info("Using cached service metadata from %s", cache_file)
+                    return service_metadata
+            except (OSError, ValueError):
+                # no usable cached copy
+                pass
+
         logger.info("Fetching service metadata")
-        type_to_sel: dict[str, str] = {}
         with self.session.get(self.endpoint + "/metadata") as resp:
-            if resp.status_code == 200:
-                service_metadata = resp.json()
-                all_selectors = []
-                if service_metadata.get("defaultAnnotations"):
-                    all_selectors.extend(sel.strip() for sel in service_metadata["defaultAnnotations"].split(","))
-                if service_metadata.get("additionalAnnotations"):
-                    all_selectors.extend(sel.strip() for sel in service_metadata["additionalAnnotations"].split(","))
-                for selector in all_selectors:
-                    as_name, _, ann_type = selector.partition(":")
-                    if ann_type not in type_to_sel:
-                        type_to_sel[ann_type] = selector
-            else:
+            if resp.status_code != 200:
                 logger.warning("Could not access service metadata")
+                return None
+            service_metadata = resp.json()
+
+        if self.use_metadata_cache:
+            try:
+                os.makedirs(metadata_cache_dir, exist_ok=True)
+                with open(cache_file, "w", encoding="utf-8") as f:
+                    json.dump(service_metadata, f)
+            except OSError:
+                logger.warning("Could not cache service metadata in %s", cache_file, exc_info=True)
+
+        return service_metadata
+
+    def get_annotations_from_metadata(self):
+        type_to_sel: dict[str, str] = {}
+        service_metadata = self.fetch_service_metadata()
+        if service_metadata:
+            all_selectors = itertools.chain(
+                (service_metadata.get("defaultAnnotations") or "").split(","),
+                (service_metadata.get("additionalAnnotations") or "").split(","),
+            )
+            for selector in all_selectors:
+                selector = selector.strip()
+                if selector:
+                    type_to_sel.setdefault(selector.partition(":")[2], selector)
 
         return type_to_sel
 
-    def handle_rate_limit(self, response: requests.Response) -> float:
+    def new_session(self) -> requests.Session:
+        session = requests.Session()
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        return session
+
+    def get_session(self) -> requests.Session:
+        session = getattr(self.thread_local, "session", None)
+        if session is None:
+            session = self.new_session()
+            session.headers.update(self.session.headers)
+            self.thread_local.session = session
+        return session
+
+    def wait_for_call_slot(self) -> float:
+        """
+        Block until the rate limit allows another API call to start, and reserve that slot.
+
+        Returns:
+            the time.monotonic() time at which the call is allowed to start
+        """
+        while True:
+            self.check_give_up()
+            with self.rate_limit_lock:
+                now = time.monotonic()
+                if self.next_call_time <= now:
+                    self.next_call_time = now + self.call_interval
+                    return now
+                wait_time = self.next_call_time - now
+            if wait_time > 5.0:
+                logger.info("Waiting %.2f seconds before next API call for rate limiting", wait_time)
+            # wakes up early if another worker gives up in the meantime
+            self.give_up.wait(wait_time)
+
+    def check_give_up(self):
+        if self.give_up.is_set():
+            # another worker has already reported the problem
+            sys.exit(1)
+
+    def handle_rate_limit(self, response: requests.Response, request_start_time: float):
         # Logic:
         #
-        # - if we've already hit the rate limit or quota then just wait until the retry time
+        # - if we've already hit the rate limit or quota then no call may start until the retry time
         # - otherwise take the max of this request cost and the difference between remaining rate limit
         #   after this request and the remaining rate limit after the previous call (which might be more than
         #   one call used up if there's another run going in parallel)
-        # - divide the time until rate limit reset by this number to get the wait time between calls that should
+        # - divide the time until rate limit reset by this number to get the interval between calls that should
         #   "use up" that rate limit precisely by the reset time, and multiply by 1.05 so we don't actually hit
         #   the limit
-        # - actual wait time before starting the next call is then this time minus "now" plus the time that
-        #   this request _started_ (so we're limiting the start-to-start times rather than the end-to-start)
-        # - if the final result is less than 0, return 0 (i.e. no need to wait at all)
+        # - this interval is measured from the time that this request _started_ (so we're limiting the
+        #   start-to-start times rather than the end-to-start), and is shared by all the worker threads via
+        #   wait_for_call_slot
         try:
-            if (response.status_code == 429 or response.status_code == 402) and ("retry-after" in response.headers):
+            # look up each header once - the case-insensitive header dict is not free
+            headers = response.headers
+            retry_after = headers.get("retry-after")
+            if (response.status_code == 429 or response.status_code == 402) and retry_after is not None:
                 # already hit the rate limit
-                logger.info("Rate limit reached - waiting %s seconds", response.headers["retry-after"])
-                return float(response.headers["retry-after"])
-
+                logger.info("Rate limit reached - waiting %s seconds", retry_after)
+                with self.rate_limit_lock:
+                    self.next_call_time = max(self.next_call_time, time.monotonic() + float(retry_after))
+                    # only let one call at a time through until a successful response tells us
+                    # the real rate limit again
+                    self.call_interval = max(self.call_interval, float(retry_after))
+                return
+
+            rate_limit_calls = headers.get("x-gate-rate-limit-calls")
+            rate_limit_reset = headers.get("x-gate-rate-limit-reset")
+            if rate_limit_calls is None or rate_limit_reset is None:
+                with self.rate_limit_lock:
+                    self.call_interval = 0.0
+                return
             try:
-                this_rate_limit_remaining = int(response.headers["x-gate-rate-limit-calls"])
-                time_until_reset = int(response.headers["x-gate-rate-limit-reset"])
+                this_rate_limit_remaining = int(rate_limit_calls)
+                time_until_reset = int(rate_limit_reset)
             except ValueError:
-                return 0.0
-
-            used_limit_since_last_call = 1
-            if 0 < self.prev_rate_limit_remaining < this_rate_limit_remaining:
-                used_limit_since_last_call = this_rate_limit_remaining - self.prev_rate_limit_remaining
-            self.prev_rate_limit_remaining = this_rate_limit_remaining
-
-            wait_time_until_next_call = (
-                (time_until_reset / this_rate_limit_remaining) * used_limit_since_last_call * 1.05
-            )
-            if self.request_start_time:
-                wait_time_until_next_call += self.request_start_time - time.perf_counter()
-
-            if wait_time_until_next_call > 0:
-                return wait_time_until_next_call
-            else:
-                return 0.0
+                return
+
+            with self.rate_limit_lock:
+                used_limit_since_last_call = 1
+                if 0 < self.prev_rate_limit_remaining < this_rate_limit_remaining:
+                    used_limit_since_last_call = this_rate_limit_remaining - self.prev_rate_limit_remaining
+                self.prev_rate_limit_remaining = this_rate_limit_remaining
+
+                self.call_interval = (
+                    (time_until_reset / max(this_rate_limit_remaining, 1)) * used_limit_since_last_call * 1.05
+                )
+                self.next_call_time = max(self.next_call_time, request_start_time + self.call_interval)
         finally:
             response.close()
 
+    def process_text(self, text: str) -> list[str]:
+        """
+        Send one text to the GATE Cloud service, retrying if the rate limit is hit.  This is called from
+        the worker threads, so must not touch any shared state other than the rate limiting.
+
+        Returns:
+            the status column followed by the annotation output columns for this text
+        """
+        while True:
+            self.check_give_up()
+            # pass text to cloud service
+            try:
+                request_start_time = self.wait_for_call_slot()
+                response = self.get_session().post(self.post_url, data=text.encode("utf-8"))
+            except requests.RequestException as e:
+                logger.exception("Error making API request")
+                return [error_message(dict(message=str(e)))]
+
+            try:
+                if response.status_code == 200:
+                    resp_json = json_loads(response.content)
+                    if "text" in resp_json and "entities" in resp_json:
+                        with self.rate_limit_lock:
+                            self.rate_limit_failures = 0
+                        return ["Success", *self.extract_outputs(resp_json)]
+                    err_json = resp_json
+                elif response.status_code == 429 or response.status_code == 402:
+                    # Rate limit or quota has been hit
+                    with self.rate_limit_lock:
+                        if request_start_time >= self.last_rate_limit_time:
+                            self.rate_limit_failures += 1
+                        self.last_rate_limit_time = time.monotonic()
+                        # something is very wrong, give up, and tell the other workers to do the same
+                        first_to_give_up = self.rate_limit_failures > 5 and not self.give_up.is_set()
+                        if first_to_give_up:
+                            self.give_up.set()
+                    if first_to_give_up:
+                        logger.error("Rate limit reached too many times")
+                    continue
+                else:
+                    # Genuine error response
+                    try:
+                        err_json = response.json()
+                    except requests.JSONDecodeError:
+                        err_json = dict(message=response.text)
+            except (requests.RequestException, ValueError) as e:
+                logger.exception("Error reading API response")
+                err_json = dict(message=str(e))
+            finally:
+                self.handle_rate_limit(response, request_start_time)
+
+            return [error_message(err_json)]
+
     def run(self, in_file, in_encoding, out_file, out_encoding):
         # Record size of the input file for progress reporting
         in_file_size = os.path.getsize(in_file)
@@ -236,7 +543,7 @@ class CsvProcessor:
                     copy_columns = [(int(c) - 1) for c in self.copy_columns]
 
                 logger.info("Writing to output file '%s' with encoding %s", out_file, out_encoding)
-                with open(out_file, "w", encoding=out_encoding, newline="") as out_f:
+                with open(out_file, "w", encoding=out_encoding, newline="", buffering=1 << 18) as out_f:
                     w = csv.writer(out_f)
                     col_headers = []
                     if self.has_headers:
@@ -249,67 +556,88 @@ class CsvProcessor:
                     col_headers.extend(self.output_columns)
                     w.writerow(col_headers)
 
-                    rate_limit_failures = 0
-                    wait_before_next_call = 0.0
-
-                    with tqdm(total=in_file_size, unit="B", unit_scale=True) as pbar:
+                    # Rows that have been submitted to the worker pool, in input order.  Each entry is
+                    # the copied columns, the future for the API call results, the position in the
+                    # input file after reading that row (only recorded for every 100th row, None
+                    # otherwise), and the text if the future was shared with an earlier row with the
+                    # same text (None otherwise).  We keep a few more rows in flight than there
+                    # are workers so the pool is never starved while we wait for the oldest row.
+                    copy_row = columns_getter(copy_columns)
+                    pending = deque()
+                    max_pending = 2 * self.concurrency
+                    # Recently seen texts, mapped to the future for their results, so that
+                    # duplicate texts don't need another API call.  This is an LRU cache - the
+                    # least recently used text is at the start.
+                    recent_texts = OrderedDict()
+                    # Finished rows are written out in batches rather than one at a time
+                    out_buffer = []
+
+                    with tqdm(total=in_file_size, unit="B", unit_scale=True, mininterval=0.25) as pbar:
                         in_file_pos = 0
-                        for idx, row in enumerate(r):
-                            text = row[text_column]
-                            err_json = None
-                            while True:
-                                results = [row[c] for c in copy_columns]
-                                # pass text to cloud service
-                                try:
-                                    if wait_before_next_call > 5.0:
-                                        logger.info(
-                                            "Waiting %.2f seconds before next API call for rate limiting",
-                                            wait_before_next_call,
-                                        )
-                                    time.sleep(wait_before_next_call)
-                                    self.request_start_time = time.perf_counter()
-                                    response = self.session.post(self.endpoint, params=self.ann_selectors, data=text)
-                                    if response.status_code == 200:
-                                        resp_json = response.json()
-                                        if "text" in resp_json and "entities" in resp_json:
-                                            results.append("Success")
-                                            results.extend(f(resp_json) for f in self.output_functions)
-                                            break
-                                    elif response.status_code == 429 or response.status_code == 402:
-                                        # Rate limit or quota has been hit
-                                        rate_limit_failures += 1
-                                        if rate_limit_failures > 5:
-                                            # something is very wrong, give up
-                                            logger.error("Rate limit reached too many times")
-                                            sys.exit(1)
-                                        wait_before_next_call = self.handle_rate_limit(response)
-                                    else:
-                                        # Genuine error response
-                                        try:
-                                            err_json = response.json()
-                                        except requests.JSONDecodeError:
-                                            err_json = dict(message=response.text)
-                                        break
-                                except requests.RequestException as e:
-                                    logger.exception("Error making API request")
-                                    err_json = dict(message=str(e))
-                                    break
-
-                            wait_before_next_call = self.handle_rate_limit(response)
-
-                            if err_json:
-                                if "message" in err_json:
-                                    results.append(f"Error: {err_json['message']}")
-                                else:
-                                    results.append(f"Error: {json.dumps(err_json)}")
-
-                            w.writerow(results)
-
-                            # update the progress bar
-                            new_file_pos = in_binary.tell()
-                            bytes_read = new_file_pos - in_file_pos
-                            in_file_pos = new_file_pos
-                            pbar.update(bytes_read)
+
+                        # The GATE Cloud processing API takes exactly one document per call, so there
+                        # is no way to batch several rows into one request - keeping several calls in
+                        # flight at once is how we hide the per-call latency instead.
+                        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+                            # returns the future for the results for this text, and whether that
+                            # future is shared with an earlier row
+                            def submit(text):
+                                if self.dedup_cache_size:
+                                    future = recent_texts.get(text)
+                                    # re-use the same call unless it has already failed
+                                    if future is not None and not (future.done() and future.result()[0] != "Success"):
+                                        recent_texts.move_to_end(text)
+                                        return future, True
+
+                                future = executor.submit(self.process_text, text)
+                                if self.dedup_cache_size:
+                                    recent_texts[text] = future
+                                    if len(recent_texts) > self.dedup_cache_size:
+                                        recent_texts.popitem(last=False)
+                                return future, False
+
+                            def write_oldest():
+                                nonlocal in_file_pos
+                                results, future, new_file_pos, shared_text = pending.popleft()
+                                outputs = future.result()
+                                if shared_text is not None and outputs[0] != "Success":
+                                    # the earlier row with the same text failed while this row was
+                                    # waiting for it, so give this row its own try
+                                    outputs = submit(shared_text)[0].result()
+                                results.extend(outputs)
+                                out_buffer.append(results)
+                                if len(out_buffer) >= 1000:
+                                    w.writerows(out_buffer)
+                                    out_buffer.clear()
+
+                                # update the progress bar, if we checked the file position for this row
+                                if new_file_pos is not None:
+                                    bytes_read = new_file_pos - in_file_pos
+                                    in_file_pos = new_file_pos
+                                    pbar.update(bytes_read)
+
+                            try:
+                                for row_num, row in enumerate(r, 1):
+                                    text = row[text_column]
+                                    future, shared = submit(text)
+                                    # only note the file position every 100 rows, the progress bar
+                                    # doesn't need to move any more often than that
+                                    file_pos = in_binary.tell() if row_num % 100 == 0 else None
+                                    pending.append((copy_row(row), future, file_pos, text if shared else None))
+                                    if len(pending) >= max_pending:
+                                        write_oldest()
+
+                                while pending:
+                                    write_oldest()
+                                pbar.update(in_binary.tell() - in_file_pos)
+                            except BaseException:
+                                # don't start any more API calls if we're bailing out
+                                executor.shutdown(cancel_futures=True)
+                                raise
+                            finally:
+                                # write any rows that have finished, even if we're bailing out
+                                w.writerows(out_buffer)
 
 
 def main():
@@ -419,6 +747,33 @@ def main():
         "header name",
     )
 
+    processing_group = parser.add_argument_group("Processing settings")
+    processing_group.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of API calls to make in parallel.  Calls are still spaced out "
+        "to stay within your GATE Cloud rate limit, so raising this mainly helps when the "
+        "service itself is slow to respond.  Default is 4.",
+    )
+    processing_group.add_argument(
+        "--dedup-cache",
+        type=int,
+        default=10000,
+        metavar="N",
+        help="Remember the results for the N most recently seen texts, and re-use them rather "
+        "than calling the API again if the same text appears again later in the file.  Set to "
+        "0 to call the API for every row.  Default is 10000.",
+    )
+    processing_group.add_argument(
+        "--no-metadata-cache",
+        action="store_false",
+        default=True,
+        dest="metadata_cache",
+        help="Always fetch the service metadata from GATE Cloud, rather than re-using a copy "
+        "cached in the last 24 hours.",
+    )
+
     output_group = parser.add_argument_group("Output settings")
     output_group.add_argument("--out", dest="out_file", required=True, help="The output CSV file")
     output_group.add_argument(
@@ -442,6 +797,10 @@ def main():
     )
 
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.dedup_cache < 0:
+        parser.error("--dedup-cache must not be negative")
 
     if args.api_key and args.api_password:
         api_key = args.api_key